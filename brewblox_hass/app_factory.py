@@ -4,7 +4,7 @@ from pprint import pformat
 
 from fastapi import FastAPI
 
-from . import mqtt, relay, utils
+from . import mqtt, relay, snapshot, utils
 
 LOGGER = logging.getLogger(__name__)
 
@@ -42,7 +42,10 @@ def create_app() -> FastAPI:
 
     # Call setup functions for modules
     mqtt.setup()
+    snapshot.setup()
     relay.setup()
 
     app = FastAPI(lifespan=lifespan)
+    app.include_router(snapshot.router, prefix=f'/{config.name}')
+    app.include_router(relay.router, prefix=f'/{config.name}')
     return app
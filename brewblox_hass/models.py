@@ -1,5 +1,6 @@
-from typing import Literal
+from typing import Any, Literal
 
+from pydantic import BaseModel, ConfigDict, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -35,3 +36,61 @@ class HassMqttCredentials(BaseSettings):
 
     mqtt_username: str | None = None
     mqtt_password: str | None = None
+
+
+class StrictModel(BaseModel):
+    """
+    Base class for event payloads.
+    Values with the wrong type are rejected instead of converted.
+    """
+    model_config = ConfigDict(strict=True)
+
+
+class SparkQuantity(StrictModel):
+    unit: str
+    value: float | None = None
+
+
+class SparkSensorData(StrictModel):
+    value: SparkQuantity
+
+
+class SparkSetpointData(StrictModel):
+    setting: SparkQuantity
+
+
+class SparkSensorBlock(StrictModel):
+    id: str
+    type: str
+    data: SparkSensorData
+
+
+class SparkSetpointBlock(StrictModel):
+    id: str
+    type: str
+    data: SparkSetpointData
+
+
+class SparkStateData(StrictModel):
+    # Blocks are validated individually,
+    # so one invalid block does not reject the whole message
+    blocks: list[Any]
+
+
+class SparkStateEvent(StrictModel):
+    key: str
+    type: Literal['Spark.state']
+    data: SparkStateData
+
+
+class TiltStateData(StrictModel):
+    temperature: float = Field(alias='temperature[degC]')
+    specificGravity: float
+    plato: float = Field(alias='plato[degP]')
+
+
+class TiltStateEvent(StrictModel):
+    key: str
+    type: Literal['Tilt.state']
+    name: str
+    data: TiltStateData
@@ -5,10 +5,17 @@ Subscribes to all Spark sensors, and publishes them to the HASS broker
 
 import json
 import logging
+import math
 import re
+from collections import Counter
 from contextvars import ContextVar
+from typing import Any
 
-from . import mqtt, utils
+from fastapi import APIRouter
+from pydantic import ValidationError
+
+from . import mqtt, snapshot, utils
+from .models import SparkSensorBlock, SparkSetpointBlock, SparkStateEvent, TiltStateEvent
 
 REPLACE_PATTERN = r'[^a-zA-Z0-9_]'
 SENSOR_TYPES = [
@@ -23,11 +30,11 @@ SETPOINT_TYPES = [
 PROFILE_TYPES = [
     'SetpointProfile',
 ]
-HANDLED_TYPES = [
-    *SENSOR_TYPES,
-    *SETPOINT_TYPES,
-    *PROFILE_TYPES,
-]
+BLOCK_MODELS: dict[str, type[SparkSensorBlock] | type[SparkSetpointBlock]] = {
+    **{t: SparkSensorBlock for t in SENSOR_TYPES},
+    **{t: SparkSetpointBlock for t in SETPOINT_TYPES},
+    **{t: SparkSetpointBlock for t in PROFILE_TYPES},
+}
 UNITS = {
     'degC': '°C',
     'degF': '°F',
@@ -37,6 +44,16 @@ UNITS = {
 
 LOGGER = logging.getLogger(__name__)
 CV_KNOWN: ContextVar[set[str]] = ContextVar('relay.known')
+CV_REJECTS: ContextVar[Counter[str]] = ContextVar('relay.rejects')
+
+router = APIRouter(tags=['Relay'])
+
+# Validation results per service, indexed by block ID.
+# The result is either the parsed block, or the reject reason.
+# Blocks are only validated again if their content changed.
+SparkBlock = SparkSensorBlock | SparkSetpointBlock
+BlockCache = dict[str, tuple[dict, SparkBlock | str]]
+CV_BLOCKS: ContextVar[dict[str, BlockCache]] = ContextVar('relay.blocks')
 
 
 def fallback(data: dict, k1: str, k2: str):
@@ -47,20 +64,98 @@ def binary_sensor_state(value: bool):
     return 'ON' if value else 'OFF'
 
 
+def reject_reason(kind: str, ex: ValidationError) -> str:
+    return f'{kind}.{ex.errors()[0]["type"]}'
+
+
+def reject(reason: str):
+    CV_REJECTS.get()[reason] += 1
+    LOGGER.debug(f'rejected {reason}')
+
+
+def parse_spark_block(block: Any, prev_cache: BlockCache, next_cache: BlockCache) -> SparkBlock | None:
+    """
+    Validates a single block from a Spark state event.
+    Returns None if the block is invalid or not handled.
+
+    Results are looked up in `prev_cache`, and written to `next_cache`.
+    """
+    if not isinstance(block, dict):
+        reject('spark_block.dict_type')
+        return None
+
+    block_type = block.get('type')
+    if not isinstance(block_type, str):
+        reject('spark_block.type')
+        return None
+
+    model_cls = BLOCK_MODELS.get(block_type)
+    if model_cls is None:
+        # Not an error: we just don't care about this block
+        return None
+
+    block_id = block.get('id')
+    if not isinstance(block_id, str):
+        reject('spark_block.id')
+        return None
+
+    cached = prev_cache.get(block_id)
+    if cached is not None and cached[0] == block:
+        result = cached[1]
+    else:
+        try:
+            result = model_cls.model_validate(block)
+        except ValidationError as ex:
+            result = reject_reason('spark_block', ex)
+
+    next_cache[block_id] = (block, result)
+
+    if isinstance(result, str):
+        reject(result)
+        return None
+
+    return result
+
+
+def publish_config(topic: str, config: dict):
+    mqtt.CV_HASS.get().publish(topic, config, retain=True)
+    snapshot.CV.get().set_discovery(topic, config)
+
+
+def finite_or_none(value: Any) -> Any:
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def publish_state(key: str, state: dict):
+    # NaN and Infinity are not valid JSON
+    state = {k: finite_or_none(v) for k, v in state.items()}
+    mqtt.CV_HASS.get().publish(f'homeassistant/brewblox/{key}/state', state)
+    snapshot.CV.get().set_state(key, state)
+
+
 def handle_spark_state(message: dict):
+    try:
+        evt = SparkStateEvent.model_validate(message)
+    except ValidationError as ex:
+        reject(reject_reason('spark_state', ex))
+        return
+
     known = CV_KNOWN.get()
-    publisher = mqtt.CV_HASS.get()
-    service = message['key']
-    blocks = message['data']['blocks']
+    service = evt.key
+    prev_blocks = CV_BLOCKS.get().get(service, {})
+    next_blocks: BlockCache = {}
 
     state_topic = f'homeassistant/brewblox/{service}/state'
     published_state = {}
 
-    for block in blocks:
-        if block['type'] not in HANDLED_TYPES:
+    for raw in evt.data.blocks:
+        block = parse_spark_block(raw, prev_blocks, next_blocks)
+        if block is None:
             continue
 
-        id: str = block['id']
+        id: str = block.id
         sanitized = re.sub(REPLACE_PATTERN, '', id)
         full = f'{service}__{sanitized}'
 
@@ -68,10 +163,10 @@ def handle_spark_state(message: dict):
             # Skip generated names
             continue
 
-        if block['type'] in SENSOR_TYPES:
-            qty = block['data']['value']
-            unit = UNITS.get(qty['unit'], qty['unit'])
-            value = qty['value']
+        if isinstance(block, SparkSensorBlock):
+            qty = block.data.value
+            unit = UNITS.get(qty.unit, qty.unit)
+            value = qty.value
 
             if value is not None:
                 value = round(value, 2)
@@ -80,7 +175,7 @@ def handle_spark_state(message: dict):
 
             if full not in known:
                 LOGGER.info(f'publishing new sensor: {id}')
-                publisher.publish(
+                publish_config(
                     f'homeassistant/sensor/{full}/config',
                     {
                         'device_class': 'temperature',
@@ -89,14 +184,13 @@ def handle_spark_state(message: dict):
                         'unit_of_measurement': unit,
                         'value_template': '{{ value_json.' + sanitized + ' }}',
                     },
-                    retain=True,
                 )
                 known.add(full)
 
-        if block['type'] in SETPOINT_TYPES:
-            qty = block['data']['setting']
-            unit = UNITS.get(qty['unit'], qty['unit'])
-            value = qty['value']
+        elif block.type in SETPOINT_TYPES:
+            qty = block.data.setting
+            unit = UNITS.get(qty.unit, qty.unit)
+            value = qty.value
 
             if value is not None:
                 value = round(value, 2)
@@ -105,7 +199,7 @@ def handle_spark_state(message: dict):
 
             if full not in known:
                 LOGGER.info(f'publishing new setpoint: {id}')
-                publisher.publish(
+                publish_config(
                     f'homeassistant/sensor/{full}/config',
                     {
                         'device_class': 'temperature',
@@ -114,19 +208,17 @@ def handle_spark_state(message: dict):
                         'unit_of_measurement': unit,
                         'value_template': '{{ value_json.' + sanitized + ' }}',
                     },
-                    retain=True,
                 )
                 known.add(full)
 
-        if block['type'] in PROFILE_TYPES:
-            qty = block['data']['setting']
-            value = qty['value']
+        elif block.type in PROFILE_TYPES:
+            value = block.data.setting.value
 
             published_state[sanitized] = binary_sensor_state(value is not None)
 
             if full not in known:
                 LOGGER.info(f'publishing new profile state: {id}')
-                publisher.publish(
+                publish_config(
                     f'homeassistant/binary_sensor/{full}/config',
                     {
                         'device_class': 'running',
@@ -134,26 +226,33 @@ def handle_spark_state(message: dict):
                         'state_topic': state_topic,
                         'value_template': '{{ value_json.' + sanitized + ' }}',
                     },
-                    retain=True,
                 )
                 known.add(full)
 
+    # Blocks that were removed or renamed are dropped from the cache
+    CV_BLOCKS.get()[service] = next_blocks
+
     if published_state:
-        publisher.publish(state_topic, published_state)
+        publish_state(service, published_state)
 
 
 def handle_tilt_state(message: dict):
+    try:
+        evt = TiltStateEvent.model_validate(message)
+    except ValidationError as ex:
+        reject(reject_reason('tilt_state', ex))
+        return
+
     known = CV_KNOWN.get()
-    publisher = mqtt.CV_HASS.get()
-    service = message['key']
-    name = message['name']
+    service = evt.key
+    name = evt.name
     sanitized = re.sub(REPLACE_PATTERN, '_', name)
     full = f'{service}_{sanitized}'
     state_topic = f'homeassistant/brewblox/{full}/state'
 
     if full not in known:
         LOGGER.info(f'publishing new Tilt: {service} {name}')
-        publisher.publish(
+        publish_config(
             f'homeassistant/sensor/{full}_temp_c/config',
             {
                 'device_class': 'temperature',
@@ -162,18 +261,16 @@ def handle_tilt_state(message: dict):
                 'unit_of_measurement': UNITS['degC'],
                 'value_template': '{{ value_json.temp_c }}',
             },
-            retain=True,
         )
-        publisher.publish(
+        publish_config(
             f'homeassistant/sensor/{full}_sg/config',
             {
                 'name': f'{service} {name} SG',
                 'state_topic': state_topic,
                 'value_template': '{{ value_json.sg }}',
             },
-            retain=True,
         )
-        publisher.publish(
+        publish_config(
             f'homeassistant/sensor/{full}_plato/config',
             {
                 'name': f'{service} {name} Plato',
@@ -181,34 +278,53 @@ def handle_tilt_state(message: dict):
                 'unit_of_measurement': UNITS['degP'],
                 'value_template': '{{ value_json.plato }}',
             },
-            retain=True,
         )
         known.add(full)
 
-    data = message['data']
-    publisher.publish(
-        state_topic,
+    data = evt.data
+    publish_state(
+        full,
         {
-            'temp_c': data['temperature[degC]'],
-            'sg': data['specificGravity'],
-            'plato': data['plato[degP]'],
+            'temp_c': data.temperature,
+            'sg': data.specificGravity,
+            'plato': data.plato,
         },
     )
 
 
+@router.get('/rejects')
+async def rejects() -> dict[str, int]:
+    """
+    Get the number of rejected payloads, events, and blocks, indexed by reason.
+    """
+    return dict(CV_REJECTS.get())
+
+
 def setup():
     config = utils.get_config()
     mqtt_in = mqtt.CV_LOCAL.get()
     CV_KNOWN.set(set())
+    CV_REJECTS.set(Counter())
+    CV_BLOCKS.set({})
 
     @mqtt_in.subscribe(config.state_topic + '/#')
     async def on_state_message(client, topic, payload, qos, properties):
-        message = json.loads(payload)
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            reject('payload.json_invalid')
+            return
+
+        if not isinstance(message, dict):
+            reject('payload.dict_type')
+            return
+
+        msg_type = message.get('type')
 
-        if message['type'] == 'Spark.state':
+        if msg_type == 'Spark.state':
             handle_spark_state(message)
             return
 
-        if message['type'] == 'Tilt.state':
+        if msg_type == 'Tilt.state':
             handle_tilt_state(message)
             return
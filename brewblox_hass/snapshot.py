@@ -0,0 +1,165 @@
+"""
+Keeps the latest relayed state and discovery configs in memory,
+and serves them over REST with ETag support
+"""
+
+
+import asyncio
+import logging
+import secrets
+from contextvars import ContextVar
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+
+MAX_WAIT_S = 60
+STATE_KEY = 'state'
+DISCOVERY_KEY = 'discovery'
+
+LOGGER = logging.getLogger(__name__)
+CV: ContextVar['SnapshotCache'] = ContextVar('snapshot.cache')
+
+router = APIRouter(tags=['Snapshot'])
+
+
+class SnapshotCache:
+    """
+    Stores the last published state per state topic,
+    and the last published discovery config per config topic.
+
+    Every resource has its own revision, so clients only
+    receive new content if their resource actually changed.
+    """
+
+    def __init__(self) -> None:
+        # Included in ETags to prevent matches with ETags issued before a restart
+        self.token = secrets.token_hex(4)
+        self.states: dict[str, dict] = {}
+        self.discovery: dict[str, dict] = {}
+        self._counter = 0
+        self._revisions: dict[str, int] = {}
+        self._changed = asyncio.Event()
+
+    def _bump(self, *keys: str):
+        self._counter += 1
+        for key in keys:
+            self._revisions[key] = self._counter
+
+        # Wake up all long-polling requests
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def etag(self, key: str) -> str:
+        return f'"{self.token}-{self._revisions.get(key, 0)}"'
+
+    def set_state(self, service: str, state: dict):
+        if self.states.get(service) == state:
+            return
+        self.states[service] = dict(state)
+        self._bump(STATE_KEY, f'{STATE_KEY}/{service}')
+
+    def set_discovery(self, topic: str, config: dict):
+        if self.discovery.get(topic) == config:
+            return
+        self.discovery[topic] = dict(config)
+        self._bump(DISCOVERY_KEY)
+
+    async def wait_change(self, key: str, etag: str, timeout: float):
+        """
+        Waits until the ETag for `key` no longer matches `etag`,
+        or `timeout` seconds have passed.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while self.etag(key) == etag:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+
+def etag_matches(header: str | None, etag: str, wildcard: bool = True) -> bool:
+    if not header:
+        return False
+    candidates = [v.strip() for v in header.split(',')]
+    return (wildcard and '*' in candidates) or etag in candidates or f'W/{etag}' in candidates
+
+
+async def respond(request: Request, key: str, wait: float, get_content) -> Response:
+    cache = CV.get()
+    header = request.headers.get('if-none-match')
+    etag = cache.etag(key)
+
+    # A wildcard matches any ETag, so there is no change to wait for
+    if wait and etag_matches(header, etag, wildcard=False):
+        await cache.wait_change(key, etag, wait)
+        etag = cache.etag(key)
+
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    if etag_matches(header, etag):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(get_content(), headers=headers)
+
+
+@router.get('/state')
+async def state_all(request: Request,
+                    wait: float = Query(0, ge=0, le=MAX_WAIT_S)) -> dict[str, dict]:
+    """
+    Get the last published state of all services.
+
+    If `wait` is set and If-None-Match matches the current ETag,
+    the response is delayed until the state changes, or `wait` seconds have passed.
+    """
+    cache = CV.get()
+    return await respond(request, STATE_KEY, wait, lambda: cache.states)
+
+
+@router.get('/state/{service}')
+async def state_service(request: Request,
+                        service: str,
+                        wait: float = Query(0, ge=0, le=MAX_WAIT_S)) -> dict:
+    """
+    Get the last published state of a single service.
+
+    If `wait` is set and If-None-Match matches the current ETag,
+    the response is delayed until the state changes, or `wait` seconds have passed.
+    If the service has not published any state yet, the response is delayed
+    until it does, or `wait` seconds have passed.
+    """
+    cache = CV.get()
+    key = f'{STATE_KEY}/{service}'
+
+    if service not in cache.states:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await cache.wait_change(key, cache.etag(key), wait)
+        # Time spent waiting for the service counts towards the total wait
+        wait = max(wait - (loop.time() - start), 0)
+
+    if service not in cache.states:
+        raise HTTPException(status_code=404, detail=f'Unknown service: {service}')
+
+    return await respond(request, key, wait, lambda: cache.states[service])
+
+
+@router.get('/discovery')
+async def discovery(request: Request,
+                    wait: float = Query(0, ge=0, le=MAX_WAIT_S)) -> dict[str, dict]:
+    """
+    Get all published discovery configs, indexed by config topic.
+
+    If `wait` is set and If-None-Match matches the current ETag,
+    the response is delayed until a config changes, or `wait` seconds have passed.
+    """
+    cache = CV.get()
+    return await respond(request, DISCOVERY_KEY, wait, lambda: cache.discovery)
+
+
+def setup():
+    CV.set(SnapshotCache())
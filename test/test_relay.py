@@ -3,14 +3,17 @@ Tests message relay
 """
 
 import asyncio
+import copy
 import json
 from contextlib import AsyncExitStack, asynccontextmanager
 
 import pytest
 from fastapi import FastAPI
 from httpx import AsyncClient
+from pytest_mock import MockerFixture
 
-from brewblox_hass import mqtt, relay, utils
+from brewblox_hass import mqtt, relay, snapshot, utils
+from brewblox_hass.models import SparkSensorBlock
 
 
 class MqttListener:
@@ -47,9 +50,12 @@ def m_pub_listener() -> MqttListener:
 @pytest.fixture
 def app(m_pub_listener: MqttListener) -> FastAPI:
     mqtt.setup()
+    snapshot.setup()
     relay.setup()
     m_pub_listener.setup()
     app = FastAPI(lifespan=lifespan)
+    app.include_router(relay.router)
+    app.include_router(snapshot.router)
     return app
 
 
@@ -93,6 +99,20 @@ async def test_state_events(client: AsyncClient, m_pub_listener: MqttListener):
         'Sensor3': None,
     }]
 
+    cache = snapshot.CV.get()
+    assert cache.states == {
+        'spark-four': {
+            'Sensor1': pytest.approx(20.88),
+            'Sensor2': None,
+            'Sensor3': None,
+        },
+    }
+    assert list(cache.discovery) == [
+        'homeassistant/sensor/spark-four__Sensor1/config',
+        'homeassistant/sensor/spark-four__Sensor2/config',
+        'homeassistant/sensor/spark-four__Sensor3/config',
+    ]
+
     m_pub_listener.sensors.clear()
     m_pub_listener.state.clear()
     m_pub_listener.done.clear()
@@ -129,3 +149,138 @@ async def test_state_events(client: AsyncClient, m_pub_listener: MqttListener):
         'sg': pytest.approx(0.997),
         'plato': pytest.approx(-0.781),
     }]
+
+    assert cache.states['tilt_Purple'] == {
+        'temp_c': pytest.approx(20),
+        'sg': pytest.approx(0.997),
+        'plato': pytest.approx(-0.781),
+    }
+    assert list(cache.discovery)[3:] == [
+        'homeassistant/sensor/tilt_Purple_temp_c/config',
+        'homeassistant/sensor/tilt_Purple_sg/config',
+        'homeassistant/sensor/tilt_Purple_plato/config',
+    ]
+    assert cache.discovery['homeassistant/sensor/tilt_Purple_sg/config'] == {
+        'name': 'tilt Purple SG',
+        'state_topic': 'homeassistant/brewblox/tilt_Purple/state',
+        'value_template': '{{ value_json.sg }}',
+    }
+
+
+async def test_non_finite_state(client: AsyncClient):
+    relay.publish_state('spark-four', {
+        'Sensor1': float('nan'),
+        'Sensor2': float('inf'),
+        'Sensor3': 20.5,
+    })
+    assert snapshot.CV.get().states['spark-four'] == {
+        'Sensor1': None,
+        'Sensor2': None,
+        'Sensor3': 20.5,
+    }
+
+    resp = await client.get('/state')
+    assert resp.status_code == 200
+    assert resp.json() == {
+        'spark-four': {
+            'Sensor1': None,
+            'Sensor2': None,
+            'Sensor3': 20.5,
+        },
+    }
+
+
+async def test_invalid_events(client: AsyncClient, m_pub_listener: MqttListener):
+    config = utils.get_config()
+    mqtt_local = mqtt.CV_LOCAL.get()
+
+    with open('test/state_event_spark.json') as f:
+        spark_evt = json.load(f)
+        spark_key = spark_evt['key']
+
+    with open('test/state_event_tilt.json') as f:
+        tilt_evt = json.load(f)
+        tilt_key = tilt_evt['key']
+
+    # Invalid blocks are skipped individually
+    for block in spark_evt['data']['blocks']:
+        if block['id'] == 'Sensor 2':
+            del block['data']['value']
+        if block['id'] == 'Sensor 3':
+            block['data']['value']['value'] = '21.5'
+    spark_evt['data']['blocks'].append('not a block')
+    spark_evt['data']['blocks'].append({'type': ['TempSensorOneWire'], 'id': 'Sensor 4'})
+
+    del tilt_evt['data']['temperature[degC]']
+
+    mqtt_local.publish(f'{config.state_topic}/{spark_key}', 'not json')
+    mqtt_local.publish(f'{config.state_topic}/{spark_key}', '[1, 2]')
+    mqtt_local.publish(f'{config.state_topic}/{tilt_key}', tilt_evt)
+    mqtt_local.publish(f'{config.state_topic}/{spark_key}', {'key': spark_key, 'type': 'Spark.state'})
+    mqtt_local.publish(f'{config.state_topic}/{spark_key}', spark_evt)
+
+    await asyncio.wait_for(m_pub_listener.done.wait(), timeout=5)
+    assert [s['name'] for s in m_pub_listener.sensors] == [
+        'Sensor 1 (spark-four)',
+    ]
+    assert m_pub_listener.state == [{
+        'Sensor1': pytest.approx(20.88),
+    }]
+
+    expected = {
+        'payload.json_invalid': 1,
+        'payload.dict_type': 1,
+        'tilt_state.missing': 1,
+        'spark_state.missing': 1,
+        'spark_block.missing': 1,
+        'spark_block.float_type': 1,
+        'spark_block.dict_type': 1,
+        'spark_block.type': 1,
+    }
+    assert relay.CV_REJECTS.get() == expected
+
+    resp = await client.get('/rejects')
+    assert resp.status_code == 200
+    assert resp.json() == expected
+
+
+async def test_block_cache(client: AsyncClient, mocker: MockerFixture):
+    s_validate = mocker.spy(SparkSensorBlock, 'model_validate')
+    blocks = relay.CV_BLOCKS.get()
+
+    with open('test/state_event_spark.json') as f:
+        spark_evt = json.load(f)
+        spark_key = spark_evt['key']
+
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    assert s_validate.call_count == 3
+    assert list(blocks[spark_key]) == ['Sensor 1', 'Sensor 2', 'Sensor 3']
+
+    # Unchanged blocks are not validated again
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    assert s_validate.call_count == 3
+
+    # Changed blocks are validated again
+    for block in spark_evt['data']['blocks']:
+        if block['id'] == 'Sensor 1':
+            block['data']['value']['value'] = 21.5
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    assert s_validate.call_count == 4
+    assert blocks[spark_key]['Sensor 1'][1].data.value.value == pytest.approx(21.5)
+
+    # Cached rejects are still counted
+    for block in spark_evt['data']['blocks']:
+        if block['id'] == 'Sensor 2':
+            del block['data']['value']
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    assert s_validate.call_count == 5
+    assert relay.CV_REJECTS.get() == {'spark_block.missing': 2}
+
+    # Removed blocks are dropped from the cache
+    spark_evt['data']['blocks'] = [
+        block for block in spark_evt['data']['blocks']
+        if block['id'] != 'Sensor 3'
+    ]
+    relay.handle_spark_state(copy.deepcopy(spark_evt))
+    assert list(blocks[spark_key]) == ['Sensor 1', 'Sensor 2']
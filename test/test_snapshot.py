@@ -0,0 +1,154 @@
+"""
+Tests the cached state snapshot API
+"""
+
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from brewblox_hass import snapshot
+
+
+@pytest.fixture
+def app() -> FastAPI:
+    snapshot.setup()
+    app = FastAPI()
+    app.include_router(snapshot.router, prefix='/hass')
+    return app
+
+
+async def test_state(client: AsyncClient):
+    cache = snapshot.CV.get()
+
+    resp = await client.get('/hass/state')
+    assert resp.status_code == 200
+    assert resp.json() == {}
+    etag = resp.headers['etag']
+
+    resp = await client.get('/hass/state', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    resp = await client.get('/hass/state/spark-one')
+    assert resp.status_code == 404
+
+    cache.set_state('spark-one', {'Sensor1': 20.5})
+    cache.set_state('spark-two', {'Sensor1': 10})
+
+    resp = await client.get('/hass/state', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json() == {
+        'spark-one': {'Sensor1': 20.5},
+        'spark-two': {'Sensor1': 10},
+    }
+    assert resp.headers['etag'] != etag
+
+    resp = await client.get('/hass/state/spark-one')
+    assert resp.status_code == 200
+    assert resp.json() == {'Sensor1': 20.5}
+    one_etag = resp.headers['etag']
+
+    # Changes to other services or unchanged state do not affect the ETag
+    cache.set_state('spark-one', {'Sensor1': 20.5})
+    cache.set_state('spark-two', {'Sensor1': 11})
+    resp = await client.get('/hass/state/spark-one', headers={'If-None-Match': one_etag})
+    assert resp.status_code == 304
+    assert resp.headers['etag'] == one_etag
+
+
+async def test_discovery(client: AsyncClient):
+    cache = snapshot.CV.get()
+
+    resp = await client.get('/hass/discovery')
+    assert resp.status_code == 200
+    assert resp.json() == {}
+    etag = resp.headers['etag']
+
+    cache.set_discovery('homeassistant/sensor/spark-one__Sensor1/config', {'name': 'Sensor 1 (spark-one)'})
+
+    resp = await client.get('/hass/discovery', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json() == {
+        'homeassistant/sensor/spark-one__Sensor1/config': {'name': 'Sensor 1 (spark-one)'},
+    }
+
+
+async def test_long_poll(client: AsyncClient):
+    cache = snapshot.CV.get()
+    cache.set_state('spark-one', {'Sensor1': 20.5})
+
+    resp = await client.get('/hass/state/spark-one')
+    etag = resp.headers['etag']
+
+    # Times out without changes
+    resp = await client.get('/hass/state/spark-one',
+                            params={'wait': 0.1},
+                            headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    async def update():
+        await asyncio.sleep(0.1)
+        cache.set_state('spark-one', {'Sensor1': 21})
+
+    task = asyncio.create_task(update())
+    resp = await client.get('/hass/state/spark-one',
+                            params={'wait': 5},
+                            headers={'If-None-Match': etag})
+    await task
+    assert resp.status_code == 200
+    assert resp.json() == {'Sensor1': 21}
+    assert resp.headers['etag'] != etag
+
+    # Unknown services are awaited before returning 404
+    resp = await client.get('/hass/state/spark-two', params={'wait': 0.1})
+    assert resp.status_code == 404
+
+    async def create():
+        await asyncio.sleep(0.1)
+        cache.set_state('spark-two', {'Sensor1': 10})
+
+    task = asyncio.create_task(create())
+    resp = await client.get('/hass/state/spark-two', params={'wait': 5})
+    await task
+    assert resp.status_code == 200
+    assert resp.json() == {'Sensor1': 10}
+
+    resp = await client.get('/hass/state', params={'wait': 1000})
+    assert resp.status_code == 422
+
+
+async def test_wildcard(client: AsyncClient):
+    cache = snapshot.CV.get()
+    cache.set_state('spark-one', {'Sensor1': 20.5})
+
+    # Wildcards do not long-poll
+    resp = await asyncio.wait_for(
+        client.get('/hass/state', params={'wait': 5}, headers={'If-None-Match': '*'}),
+        timeout=1,
+    )
+    assert resp.status_code == 304
+
+
+async def test_unknown_service_wait(client: AsyncClient):
+    cache = snapshot.CV.get()
+    loop = asyncio.get_running_loop()
+
+    # The ETag that spark-one will have after its first state
+    etag = f'"{cache.token}-1"'
+
+    async def create():
+        await asyncio.sleep(0.2)
+        cache.set_state('spark-one', {'Sensor1': 20.5})
+
+    # Time spent waiting for the service is subtracted
+    # from the time spent waiting for a changed ETag
+    task = asyncio.create_task(create())
+    start = loop.time()
+    resp = await client.get('/hass/state/spark-one',
+                            params={'wait': 0.5},
+                            headers={'If-None-Match': etag})
+    await task
+    assert resp.status_code == 304
+    assert resp.headers['etag'] == etag
+    assert loop.time() - start < 0.65